@@ -140,6 +140,9 @@ def set_adv_setting(_id: str, value: Optional[bool]):
     settings, version = _read_settings_file(settings_file)
     settings[_id] = value
     _write_settings_file(settings, version, settings_file)
+    # imported here because feature_flags imports this module
+    from opentrons.config import feature_flags
+    feature_flags.clear_cache()
 
 
 def _clean_id(_id: str) -> str:
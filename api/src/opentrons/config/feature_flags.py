@@ -1,29 +1,54 @@
+import os
+from typing import Dict, Optional, Tuple
+
 from opentrons.config import advanced_settings as advs
 
 
+# Flag values keyed by (setting name, value of its env override or None if it
+# is unset). Keying on the env var means changes to the environment are picked
+# up without an explicit invalidation; changes to the settings file go through
+# advanced_settings.set_adv_setting, which calls clear_cache()
+_FLAG_CACHE: Dict[Tuple[str, Optional[str]], bool] = {}
+
+
+def clear_cache():
+    """ Drop all cached feature flag values so that they are re-read """
+    _FLAG_CACHE.clear()
+
+
+def _cached(name: str) -> bool:
+    key = (name, os.environ.get('OT_API_FF_' + name))
+    try:
+        return _FLAG_CACHE[key]
+    except KeyError:
+        value = advs.get_setting_with_env_overload(name)
+        _FLAG_CACHE[key] = value
+        return value
+
+
 def short_fixed_trash():
-    return advs.get_setting_with_env_overload('shortFixedTrash')
+    return _cached('shortFixedTrash')
 
 
 def calibrate_to_bottom():
-    return advs.get_setting_with_env_overload('calibrateToBottom')
+    return _cached('calibrateToBottom')
 
 
 def dots_deck_type():
-    return advs.get_setting_with_env_overload('deckCalibrationDots')
+    return _cached('deckCalibrationDots')
 
 
 def disable_home_on_boot():
-    return advs.get_setting_with_env_overload('disableHomeOnBoot')
+    return _cached('disableHomeOnBoot')
 
 
 def use_protocol_api_v2():
-    return advs.get_setting_with_env_overload('useProtocolApi2')
+    return _cached('useProtocolApi2')
 
 
 def use_old_aspiration_functions():
-    return advs.get_setting_with_env_overload('useOldAspirationFunctions')
+    return _cached('useOldAspirationFunctions')
 
 
 def enable_backcompat():
-    return advs.get_setting_with_env_overload('enableApi1BackCompat')
+    return _cached('enableApi1BackCompat')
@@ -13,6 +13,10 @@ from opentrons.protocols.types import PythonProtocol, Protocol
 
 MODULE_LOG = logging.getLogger(__name__)
 
+# The call into a python protocol's run function, compiled once rather than
+# on every execution
+_RUN_CALL = compile('run(context)', '<string>', 'exec')
+
 PROTOCOL_MALFORMED = """
 
 A Python protocol for the OT2 must define a function called 'run' that takes a
@@ -107,7 +111,7 @@ def _run_python(
         raise MalformedProtocolError(str(se))
     new_globs.update(new_locs)
     try:
-        exec('run(context)', new_globs, new_locs)
+        exec(_RUN_CALL, new_globs, new_locs)
     except Exception as e:
         exc_type, exc_value, tb = sys.exc_info()
         try:
@@ -5,13 +5,17 @@ a protocol from the command line.
 """
 
 import argparse
-
+import collections
+import copy
+import functools
+import hashlib
 import sys
 import logging
 import os
 import pathlib
-import queue
-from typing import Any, Dict, List, Mapping, TextIO, Tuple, BinaryIO, Optional
+from typing import (
+    Any, Callable, Dict, List, Mapping, TextIO, Tuple, BinaryIO, Optional,
+    Union)
 
 
 import opentrons
@@ -20,23 +24,164 @@ import opentrons.broker
 import opentrons.config
 from opentrons.protocols import parse, bundle
 from opentrons.protocols.types import (
-    JsonProtocol, PythonProtocol, BundleContents)
+    JsonProtocol, PythonProtocol, BundleContents, Protocol)
 from opentrons.protocol_api import execute
 from .util.entrypoint_util import labware_from_paths, datafiles_from_paths
 
+# The most recently parsed protocols, keyed by (content digest, file name,
+# apiv2 flag) and oldest first. Set OT_DISABLE_PARSE_CACHE=1 in the
+# environment to always reparse.
+_PARSE_CACHE: 'collections.OrderedDict[Tuple[bytes, str, bool], Protocol]'\
+    = collections.OrderedDict()
+_PARSE_CACHE_SIZE = 8
+_DIGEST_CHUNK = 65536
+
+
+def _digest(contents: Union[str, bytes]) -> bytes:
+    """ Hash protocol contents without making an encoded copy of all of it
+
+    Text is encoded and fed to the hash a chunk at a time, so that large
+    protocols (e.g. json with embedded labware) are not held in memory
+    twice.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    if isinstance(contents, str):
+        for start in range(0, len(contents), _DIGEST_CHUNK):
+            hasher.update(
+                contents[start:start + _DIGEST_CHUNK].encode('utf-8'))
+    else:
+        hasher.update(contents)
+    return hasher.digest()
+
+
+def _parse_cached(contents: Union[str, bytes],
+                  file_name: str,
+                  use_v2: bool) -> Protocol:
+    """ Parse a protocol, reusing the result of earlier identical parses.
+
+    Custom labware and data are not passed to the parser; for the protocols
+    that use them, :py:func:`simulate` attaches them to the result. Mutable
+    members are copied so that a simulation cannot affect later hits;
+    labware definitions are shared rather than copied, since nothing that
+    runs a protocol modifies them (the same rule as :py:func:`_load_cached`).
+    """
+    if os.environ.get('OT_DISABLE_PARSE_CACHE', '').lower()\
+       in ('1', 'true', 'on'):
+        return parse.parse(contents, file_name)
+    key = (_digest(contents), file_name, use_v2)
+    cached = _PARSE_CACHE.get(key)
+    if cached is None:
+        cached = parse.parse(contents, file_name)
+        _PARSE_CACHE[key] = cached
+        if len(_PARSE_CACHE) > _PARSE_CACHE_SIZE:
+            _PARSE_CACHE.popitem(last=False)
+    else:
+        _PARSE_CACHE.move_to_end(key)
+    if isinstance(cached, JsonProtocol):
+        return cached._replace(contents=copy.deepcopy(cached.contents))
+    if cached.bundled_labware is None:
+        return cached._replace(metadata=dict(cached.metadata))
+    return cached._replace(
+        metadata=dict(cached.metadata),
+        bundled_labware=dict(cached.bundled_labware),
+        bundled_data=dict(cached.bundled_data or {}),
+        bundled_python=dict(cached.bundled_python or {}))
+
+
+_Signature = Tuple[Tuple[int, int, Tuple[Tuple[str, int, int], ...]], ...]
+# Loaded labware and data files, one entry per tuple of absolute paths along
+# with the signature of those paths when they were loaded
+_LW_CACHE: Dict[Tuple[str, ...],
+                Tuple[_Signature, Dict[str, Dict[str, Any]]]] = {}
+_DATA_CACHE: Dict[Tuple[str, ...], Tuple[_Signature, Dict[str, bytes]]] = {}
+
+
+def _paths_signature(paths: Tuple[str, ...]) -> _Signature:
+    """ Build a signature that changes whenever anything in ``paths`` does.
+
+    A directory's mtime does not change when a file in it is rewritten in
+    place, so the stat of every direct child is included as well (the
+    loaders do not recurse).
+    """
+    sig = []
+    for path in paths:
+        st = os.stat(path)
+        children = []
+        if os.path.isdir(path):
+            with os.scandir(path) as it:
+                for entry in it:
+                    est = entry.stat()
+                    children.append(
+                        (entry.name, est.st_mtime_ns, est.st_size))
+        sig.append((st.st_mtime_ns, st.st_size, tuple(sorted(children))))
+    return tuple(sig)
+
+
+def _load_cached(cache: Dict[Tuple[str, ...], Tuple[_Signature, Any]],
+                 loader: Callable[[List[str]], Any],
+                 paths: List[str]) -> Any:
+    """ Call ``loader`` on ``paths`` unless they are unchanged since the last
+    time they were loaded into ``cache``. Returns a shallow copy: labware
+    definitions and data file contents are shared between hits, since
+    nothing that runs a protocol modifies them.
+    """
+    abspaths = tuple(os.path.abspath(path) for path in paths)
+    try:
+        sig = _paths_signature(abspaths)
+    except OSError:
+        # let the loader report the bad path
+        return loader(paths)
+    entry = cache.get(abspaths)
+    if entry is None or entry[0] != sig:
+        entry = (sig, loader(paths))
+        cache[abspaths] = entry
+    return dict(entry[1])
+
+
+def _cached_labware(paths: List[str]) -> Dict[str, Dict[str, Any]]:
+    """ :py:func:`.labware_from_paths`, skipping reparsing unchanged paths """
+    return _load_cached(_LW_CACHE, labware_from_paths, paths)
+
+
+def _cached_datafiles(paths: List[str]) -> Dict[str, bytes]:
+    """ :py:func:`.datafiles_from_paths`, skipping rereading unchanged paths
+    """
+    return _load_cached(_DATA_CACHE, datafiles_from_paths, paths)
+
+
+# The levels accepted by the --log-level option of the entrypoint
+_LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
 
 class AccumulatingHandler(logging.Handler):
     def __init__(self, level, command_queue):
         """ Create the handler
 
         :param level: The logging level to capture
-        :param command_queue: The queue.Queue to use for messages
+        :param command_queue: The list to accumulate messages in
         """
         self._command_queue = command_queue
         super().__init__(level)
 
+    def handle(self, record):
+        """ Filter and emit the record without taking the handler lock.
+
+        The scraper only ever sees records from the thread running the
+        protocol, and emitting synchronously keeps records attached to the
+        command that produced them, so the lock is just overhead.
+        """
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
     def emit(self, record):
-        self._command_queue.put(record)
+        self._command_queue.append(record)
 
 
 class CommandScraper:
@@ -46,6 +191,9 @@ class CommandScraper:
     messages from (e.g. ``logging.getLogger('opentrons')``), the
     level to scrape, and the opentrons broker object to subscribe to.
 
+    Call :py:meth:`close` (or use the scraper as a context manager) when
+    done scraping to detach it from the logger and the broker.
+
     The :py:attr:`commands` property contains the list of commands
     and log messages integrated together. Each element of the list is
     a dict following the pattern in the docs of :py:meth:`simulate`.
@@ -57,48 +205,81 @@ class CommandScraper:
         """ Build the scraper.
 
         :param logger: The :py:class:`logging.logger` to scrape
-        :param level: The log level to scrape
+        :param level: The log level to scrape. If ``'none'`` and the logger
+                      does not propagate, it is disabled entirely so that no
+                      log records are created at all until the scraper is
+                      closed. A propagating logger is left alone so that its
+                      records still reach the caller's handlers.
         :param broker: Which broker to subscribe to
         """
         self._logger = logger
         self._broker = broker
-        self._queue = queue.Queue()  # type: ignore
+        self._queue: List[logging.LogRecord] = []
+        self._saved_log_state: Optional[Tuple[int, int]] = None
+        self._handler: Optional[AccumulatingHandler] = None
         if level != 'none':
-            level = getattr(logging, level.upper(), logging.WARNING)
-            self._logger.setLevel(level)
-            logger.addHandler(
-                AccumulatingHandler(
-                    level,
-                    self._queue))
+            level_num = _LOG_LEVELS.get(level)
+            if level_num is None:
+                level_num = getattr(logging, level.upper(), logging.WARNING)
+            self._logger.setLevel(level_num)
+            self._handler = AccumulatingHandler(level_num, self._queue)
+            logger.addHandler(self._handler)
+        elif not logger.propagate:
+            self._saved_log_state = (logger.level, logger.disabled)
+            logger.disabled = True
+            logger.setLevel(logging.CRITICAL + 1)
         self._depth = 0
-        self._commands: List[Mapping[str, Mapping[str, Any]]] = []
+        self._commands: List[Mapping[str, Any]] = []
         self._unsub = self._broker.subscribe(
             opentrons.commands.command_types.COMMAND,
             self._command_callback)
 
     @property
-    def commands(self) -> List[Mapping[str, Mapping[str, Any]]]:
+    def commands(self) -> List[Mapping[str, Any]]:
         """ The list of commands. See :py:meth:`simulate` """
         return self._commands
 
-    def __del__(self):
-        if hasattr(self, '_handler'):
+    def close(self):
+        """ Stop scraping: remove the log handler, restore the logger if it
+        was disabled, and unsubscribe from the broker. The scraped
+        :py:attr:`commands` remain available. Safe to call more than once.
+        """
+        if getattr(self, '_handler', None):
             self._logger.removeHandler(self._handler)
-        if hasattr(self, '_unsub'):
+            self._handler = None
+        if getattr(self, '_saved_log_state', None):
+            self._logger.setLevel(self._saved_log_state[0])
+            self._logger.disabled = self._saved_log_state[1]
+            self._saved_log_state = None
+        if getattr(self, '_unsub', None):
             self._unsub()
+            self._unsub = None
+
+    def __enter__(self) -> 'CommandScraper':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
 
     def _command_callback(self, message):
         """ The callback subscribed to the broker """
         payload = message['payload']
+        depth = self._depth
         if message['$'] == 'before':
-            self._commands.append({'level': self._depth,
+            self._commands.append({'level': depth,
                                    'payload': payload,
                                    'logs': []})
-            self._depth += 1
+            self._depth = depth + 1
         else:
-            while not self._queue.empty():
-                self._commands[-1]['logs'].append(self._queue.get())
-            self._depth = max(self._depth-1, 0)
+            pending = self._queue
+            if pending:
+                self._commands[-1]['logs'].extend(pending)
+                pending.clear()
+            if depth:
+                self._depth = depth - 1
 
 
 def bundle_from_sim(
@@ -109,11 +290,13 @@ def bundle_from_sim(
     From a protocol, and the context that has finished simulating that
     protocol, determine what needs to go in a bundle for the protocol.
     """
-    bundled_labware: Dict[str, Dict[str, Any]] = {}
-    for lw in context.loaded_labwares.values():
-        if isinstance(lw, opentrons.protocol_api.labware.Labware)\
-           and lw.uri not in bundled_labware:
-            bundled_labware[lw.uri] = lw._definition
+    labware_cls = opentrons.protocol_api.labware.Labware
+    # labware with the same uri share a definition, so it does not matter
+    # which of them ends up in the dict
+    bundled_labware: Dict[str, Dict[str, Any]] = {
+        lw.uri: lw._definition
+        for lw in context.loaded_labwares.values()
+        if isinstance(lw, labware_cls)}
 
     return BundleContents(protocol.text,
                           bundled_data=context.bundled_data,
@@ -192,24 +375,16 @@ def simulate(protocol_file: TextIO,
     stack_logger = logging.getLogger('opentrons')
     stack_logger.propagate = propagate_logs
 
-    contents = protocol_file.read()
-    if custom_labware_paths:
-        extra_labware = labware_from_paths(custom_labware_paths)
-    else:
-        extra_labware = {}
-    if custom_data_paths:
-        extra_data = datafiles_from_paths(custom_data_paths)
-    else:
-        extra_data = {}
+    feature_flags = opentrons.config.feature_flags
+    use_v2 = feature_flags.use_protocol_api_v2()
 
-    protocol = parse.parse(contents, file_name,
-                           extra_labware=extra_labware,
-                           extra_data=extra_data)
+    contents = protocol_file.read()
+    protocol = _parse_cached(contents, file_name, use_v2)
 
-    if opentrons.config.feature_flags.use_protocol_api_v2():
+    if use_v2:
         if isinstance(protocol, PythonProtocol)\
            and protocol.api_level == '1'\
-           and not opentrons.config.feature_flags.enable_backcompat():
+           and not feature_flags.enable_backcompat():
             raise RuntimeError(
                 'This protocol targets Protocol API V1, but the robot is '
                 'set to Protocol API V2. If this is actually a V2 '
@@ -217,14 +392,29 @@ def simulate(protocol_file: TextIO,
                 'metadata. If you do not want to be on API V2, please '
                 'disable the \'Use Protocol API version 2\' toggle in the '
                 'robot\'s Advanced Settings and restart the robot.')
+        if isinstance(protocol, PythonProtocol)\
+           and protocol.bundled_labware is None:
+            # Only unbundled python protocols on apiv2 can use custom
+            # labware and data, so only load them here
+            if custom_labware_paths:
+                extra_labware = _cached_labware(custom_labware_paths)
+            else:
+                extra_labware = {}
+            if custom_data_paths:
+                extra_data = _cached_datafiles(custom_data_paths)
+            else:
+                extra_data = {}
+            protocol = protocol._replace(extra_labware=extra_labware,
+                                         bundled_data=extra_data)
         context = opentrons.protocol_api.contexts.ProtocolContext(
             bundled_labware=getattr(protocol, 'bundled_labware', None),
             bundled_data=getattr(protocol, 'bundled_data', None))
         context.home()
-        scraper = CommandScraper(stack_logger, log_level, context.broker)
-        execute.run_protocol(protocol,
-                             simulate=True,
-                             context=context)
+        with CommandScraper(stack_logger, log_level,
+                            context.broker) as scraper:
+            execute.run_protocol(protocol,
+                                 simulate=True,
+                                 context=context)
         if isinstance(protocol, PythonProtocol)\
            and protocol.bundled_labware is None:
             bundle_contents: Optional[BundleContents] = bundle_from_sim(
@@ -236,12 +426,12 @@ def simulate(protocol_file: TextIO,
         def _simulate_v1():
             import opentrons.legacy_api.protocols
             opentrons.robot.disconnect()
-            scraper = CommandScraper(stack_logger, log_level,
-                                     opentrons.robot.broker)
-            if isinstance(protocol, JsonProtocol):
-                opentrons.legacy_api.protocols.execute_protocol(protocol)
-            else:
-                exec(protocol.contents, {})
+            with CommandScraper(stack_logger, log_level,
+                                opentrons.robot.broker) as scraper:
+                if isinstance(protocol, JsonProtocol):
+                    opentrons.legacy_api.protocols.execute_protocol(protocol)
+                else:
+                    exec(protocol.contents, {})
             return scraper
 
         scraper = _simulate_v1()
@@ -258,16 +448,21 @@ def format_runlog(runlog: List[Mapping[str, Any]]) -> str:
     :param runlog: The output of a call to :py:func:`simulate`
     """
     to_ret = []
+    # indentation strings shared between all commands at the same level
+    tabs: List[str] = []
     for command in runlog:
-        to_ret.append(
-            '\t' * command['level']
-            + command['payload'].get('text', '').format(**command['payload']))
-        if command['logs']:
-            to_ret.append('\t' * command['level'] + 'Logs from this command:')
+        level = command['level']
+        payload = command['payload']
+        logs = command['logs']
+        while len(tabs) <= level:
+            tabs.append('\t' * len(tabs))
+        tab = tabs[level]
+        to_ret.append(tab + payload.get('text', '').format(**payload))
+        if logs:
+            to_ret.append(tab + 'Logs from this command:')
             to_ret.extend(
-                ['\t' * command['level']
-                 + f'{l.levelname} ({l.module}): {l.msg}' % l.args
-                 for l in command['logs']])
+                f'{tab}{l.levelname} ({l.module}): {l.getMessage()}'
+                for l in logs)
     return '\n'.join(to_ret)
 
 
@@ -361,21 +556,25 @@ def get_arguments(
     return parser
 
 
+@functools.lru_cache(maxsize=128)
+def _bundle_path_for(proto_name: str, cwd: str) -> str:
+    """ The default bundle path for a protocol, in the directory ``cwd`` """
+    protopath = pathlib.Path(proto_name)
+    # strip all the suffixes since protocols are often named
+    # .ot2.zip
+    if protopath.name.endswith('.ot2.py'):
+        protoname = pathlib.Path(protopath.stem).stem
+    else:
+        protoname = protopath.stem
+    return str((pathlib.Path(cwd) / protoname).with_suffix('.ot2.zip'))
+
+
 def _get_bundle_dest(
         bundle_name: Optional[str],
         default_key: str,
         proto_name: str) -> Optional[BinaryIO]:
     if bundle_name == default_key:
-        protopath = pathlib.Path(proto_name)
-        # strip all the suffixes since protocols are often named
-        # .ot2.zip
-        if protopath.name.endswith('.ot2.py'):
-            protoname = pathlib.Path(protopath.stem).stem
-        else:
-            protoname = protopath.stem
-        bundle_name = str((pathlib.Path.cwd() / protoname)
-                          .with_suffix('.ot2.zip'))
-        return open(bundle_name, 'wb')
+        return open(_bundle_path_for(proto_name, os.getcwd()), 'wb')
     elif bundle_name:
         return open(bundle_name, 'wb')
     else:
@@ -0,0 +1,32 @@
+from opentrons.config import advanced_settings as advs, feature_flags as ff
+
+
+def test_env_change_seen_without_clearing(monkeypatch):
+    monkeypatch.delenv('OT_API_FF_shortFixedTrash', raising=False)
+    assert not ff.short_fixed_trash()
+    monkeypatch.setenv('OT_API_FF_shortFixedTrash', 'true')
+    assert ff.short_fixed_trash()
+    monkeypatch.setenv('OT_API_FF_shortFixedTrash', '0')
+    assert not ff.short_fixed_trash()
+
+
+def test_set_adv_setting_invalidates(monkeypatch):
+    monkeypatch.delenv('OT_API_FF_shortFixedTrash', raising=False)
+    assert not ff.short_fixed_trash()
+    advs.set_adv_setting('shortFixedTrash', True)
+    assert ff.short_fixed_trash()
+    advs.set_adv_setting('shortFixedTrash', False)
+    assert not ff.short_fixed_trash()
+
+
+def test_empty_env_differs_from_unset(monkeypatch):
+    monkeypatch.delenv('OT_API_FF_shortFixedTrash', raising=False)
+    advs.set_adv_setting('shortFixedTrash', True)
+    assert ff.short_fixed_trash()
+    # an empty override is set, so it wins over the settings file
+    monkeypatch.setenv('OT_API_FF_shortFixedTrash', '')
+    assert not ff.short_fixed_trash()
+    assert ff.short_fixed_trash()\
+        == advs.get_setting_with_env_overload('shortFixedTrash')
+    monkeypatch.delenv('OT_API_FF_shortFixedTrash')
+    assert ff.short_fixed_trash()
@@ -97,9 +97,11 @@ def clear_feature_flags():
     ff_file = config.CONFIG['feature_flags_file']
     if os.path.exists(ff_file):
         os.remove(ff_file)
+    config.feature_flags.clear_cache()
     yield
     if os.path.exists(ff_file):
         os.remove(ff_file)
+    config.feature_flags.clear_cache()
 
 
 @pytest.fixture
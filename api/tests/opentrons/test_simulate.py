@@ -1,9 +1,12 @@
 # coding=utf-8
 import io
+import json
+import logging
+import pathlib
 
 import pytest
 
-from opentrons import simulate, protocols
+from opentrons import simulate, protocols, broker
 
 
 @pytest.mark.api2_only
@@ -97,3 +100,90 @@ def test_simulate_function_json_apiv1(ensure_api1,
         'Blowing out at well B1 in "3"',
         'Dropping tip well A1 in "12"'
     ]
+
+
+def test_command_scraper_close():
+    logger = logging.getLogger('opentrons.test_command_scraper')
+    brk = broker.Broker()
+    with simulate.CommandScraper(logger, 'info', brk) as scraper:
+        assert len(logger.handlers) == 1
+        brk.publish('command', {'$': 'before', 'payload': {'text': 'hi'}})
+        logger.info('during %s', 'hi')
+        brk.publish('command', {'$': 'after', 'payload': {'text': 'hi'}})
+    assert not logger.handlers
+    assert not brk.subscriptions['command']
+    assert [item['payload']['text'] for item in scraper.commands] == ['hi']
+    assert [log.getMessage() for log in scraper.commands[0]['logs']] == [
+        'during hi']
+    # closing again is harmless
+    scraper.close()
+
+
+@pytest.mark.parametrize('propagate', [False, True])
+def test_command_scraper_none_restores_logger(propagate):
+    logger = logging.getLogger('opentrons.test_command_scraper_none')
+    logger.setLevel(logging.INFO)
+    logger.propagate = propagate
+    scraper = simulate.CommandScraper(logger, 'none', broker.Broker())
+    # only a logger nobody else hears from should be silenced
+    assert logger.disabled != propagate
+    assert not logger.handlers
+    scraper.close()
+    assert logger.level == logging.INFO
+    assert not logger.disabled
+
+
+def test_parse_cache_hits_are_isolated(get_json_protocol_fixture):
+    jp = get_json_protocol_fixture('3', 'simple', False)
+    first = simulate._parse_cached(jp, 'simple.json', True)
+    first.contents['metadata']['protocol-name'] = 'changed'
+    second = simulate._parse_cached(jp, 'simple.json', True)
+    assert second.contents['metadata']['protocol-name'] != 'changed'
+
+    py = 'metadata = {"apiLevel": "2"}\n\ndef run(ctx):\n    pass\n'
+    first = simulate._parse_cached(py, 'isolated.py', True)
+    first.metadata['apiLevel'] = '1'
+    second = simulate._parse_cached(py, 'isolated.py', True)
+    assert second.metadata == {'apiLevel': '2'}
+    assert second.contents is first.contents
+
+
+def test_parse_cache_bounded_and_disableable(monkeypatch):
+    def proto(idx):
+        return f'metadata = {{"apiLevel": "2", "idx": "{idx}"}}\n'
+    first = simulate._parse_cached(proto(0), 'bounded.py', True)
+    for idx in range(1, simulate._PARSE_CACHE_SIZE + 1):
+        simulate._parse_cached(proto(idx), 'bounded.py', True)
+    assert len(simulate._PARSE_CACHE) <= simulate._PARSE_CACHE_SIZE
+    # evicted, so the protocol is compiled again
+    again = simulate._parse_cached(proto(0), 'bounded.py', True)
+    assert again.contents is not first.contents
+    monkeypatch.setenv('OT_DISABLE_PARSE_CACHE', '0')
+    assert simulate._parse_cached(proto(0), 'bounded.py', True).contents\
+        is again.contents
+    monkeypatch.setenv('OT_DISABLE_PARSE_CACHE', '1')
+    assert simulate._parse_cached(proto(0), 'bounded.py', True).contents\
+        is not again.contents
+
+
+def test_labware_cache_sees_rewrite_in_place(tmpdir):
+    defpath = pathlib.Path(__file__).parent / '..' / '..' / '..' /\
+        'shared-data' / 'labware' / 'definitions' / '2' /\
+        'corning_96_wellplate_360ul_flat' / '1.json'
+    defn = json.loads(defpath.read_text())
+    lwpath = pathlib.Path(str(tmpdir)) / 'custom.json'
+    lwpath.write_text(json.dumps(defn))
+    first = simulate._cached_labware([str(tmpdir)])
+    assert [d['metadata']['displayName'] for d in first.values()]\
+        == [defn['metadata']['displayName']]
+    entries = len(simulate._LW_CACHE)
+
+    defn['metadata']['displayName'] = 'A rewritten custom plate'
+    lwpath.write_text(json.dumps(defn))
+    second = simulate._cached_labware([str(tmpdir)])
+    assert [d['metadata']['displayName'] for d in second.values()]\
+        == ['A rewritten custom plate']
+    # the stale entry is replaced, not kept alongside the new one
+    assert len(simulate._LW_CACHE) == entries
+    assert simulate._LW_CACHE[(str(tmpdir),)][0]\
+        == simulate._paths_signature((str(tmpdir),))